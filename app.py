@@ -1,35 +1,50 @@
 import os
+import logging
+from typing import Dict, List, Tuple
 from flask import Flask, render_template, request, jsonify
 import json
-from main import LLMClient, SchemaDetectorAgent, ProfileMatchingAgent, Profile, CSVSource, JSONSource, recursive_match, NLPreprocessorAgent, recursive_match_with_full_profiles
+from main import LLMClient, SchemaDetectorAgent, ProfileMatchingAgent, Profile, CSVSource, JSONSource, recursive_match, NLPreprocessorAgent
+
+# e.g. LOG_LEVEL=DEBUG to trace the matching pipeline per row
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 
 app = Flask(__name__)
 
+# Shared across requests so the agents' caches survive between calls
+LLM = LLMClient()
+SCHEMA = SchemaDetectorAgent(LLM)
+MATCHER = ProfileMatchingAgent(LLM)
+NL = NLPreprocessorAgent(LLM)
+
 # Helper: List available data files
 DATA_DIRS = ["test_data", ".", "custom-dataset"]
-CSV_EXT = ".csv"
-JSON_EXT = ".json"
+FILE_KINDS = {"csv": "csv", "json": "json"}
+
+# dir -> (mtime_ns, {kind: [paths]}); a directory's mtime changes whenever
+# entries are added, removed or renamed, so listings are only redone then
+_dir_listing_cache: Dict[str, Tuple[int, Dict[str, List[str]]]] = {}
+
+def _list_dir(d):
+    mtime = os.stat(d).st_mtime_ns
+    cached = _dir_listing_cache.get(d)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    listing = {kind: [] for kind in FILE_KINDS.values()}
+    with os.scandir(d) as entries:
+        for entry in entries:
+            kind = FILE_KINDS.get(entry.name.rpartition(".")[2])
+            if kind and entry.is_file():
+                listing[kind].append(os.path.join(d, entry.name))
+    _dir_listing_cache[d] = (mtime, listing)
+    return listing
 
 def list_data_files():
     files = {"csv": [], "json": [], "sqlite": []}
     for d in DATA_DIRS:
-        for fname in os.listdir(d):
-            fpath = os.path.join(d, fname)
-            if os.path.isfile(fpath):
-                if fname.endswith(CSV_EXT):
-                    files["csv"].append(fpath)
-                elif fname.endswith(JSON_EXT):
-                    files["json"].append(fpath)
-                
+        for kind, paths in _list_dir(d).items():
+            files[kind].extend(paths)
     return files
 
-# Helper: Load file content
-
-def load_file_content(path):
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read()
-
-
 # Endpoint: List all available data sources
 @app.route("/api/list_sources")
 def api_list_sources():
@@ -41,20 +56,16 @@ def api_list_sources():
 def api_schema():
     data = request.json
     sources = []
-    llm = LLMClient()
-    schema_agent = SchemaDetectorAgent(llm)
     for src in data.get("sources", []):
         typ = src["type"]
         name = src["name"]
         if typ == "csv":
-            csv_str = load_file_content(name)
-            source = CSVSource(name, csv_str)
+            source = CSVSource(name, name)
         elif typ == "json":
-            json_str = load_file_content(name)
-            source = JSONSource(name, json_str)
+            source = JSONSource(name, name)
         else:
             continue
-        fields = schema_agent.detect(source)
+        fields = SCHEMA.detect(source)
         sources.append({"name": name, "type": typ, "fields": fields, "table": src.get("table")})
     return jsonify(sources)
 
@@ -64,21 +75,19 @@ def api_match():
     data = request.json
     base_profile = Profile(data["base_profile"])
     selected_sources = data["sources"]
-    llm = LLMClient()
     sources = []
     for src in selected_sources:
         typ = src["type"]
         name = src["name"]
         if typ == "csv":
-            csv_str = load_file_content(name)
-            source = CSVSource(name, csv_str)
+            source = CSVSource(name, name)
         elif typ == "json":
-            json_str = load_file_content(name)
-            source = JSONSource(name, json_str)
+            source = JSONSource(name, name)
         else:
             continue
         sources.append(source)
-    results = recursive_match(base_profile, sources, llm, threshold=0.5)
+    results = recursive_match(base_profile, sources, LLM, threshold=0.5,
+                              schema_agent=SCHEMA, matcher=MATCHER)
     # Return ranked results, enriched profile, and raw JSON
     return jsonify({
         "ranked_results": results,
@@ -97,11 +106,8 @@ def api_extract_profile():
         return jsonify({"error": "No query provided"}), 400
     
     try:
-        llm = LLMClient()
-        nl_processor = NLPreprocessorAgent(llm)
-        
         # Extract profile information from natural language
-        extracted_profile = nl_processor.extract_profile(natural_language_query)
+        extracted_profile = NL.extract_profile(natural_language_query)
         
         return jsonify({
             "success": True,
@@ -127,9 +133,7 @@ def api_match_nl():
     if "natural_language_query" in data and data["natural_language_query"].strip():
         # Process natural language input first
         try:
-            llm = LLMClient()
-            nl_processor = NLPreprocessorAgent(llm)
-            extracted_data = nl_processor.extract_profile(data["natural_language_query"])
+            extracted_data = NL.extract_profile(data["natural_language_query"])
             base_profile = Profile(extracted_data)
             input_type = "natural_language"
             original_query = data["natural_language_query"]
@@ -145,23 +149,21 @@ def api_match_nl():
         original_query = None
     
     # Continue with matching pipeline
-    llm = LLMClient()
     sources = []
     for src in selected_sources:
         typ = src["type"]
         name = src["name"]
         if typ == "csv":
-            csv_str = load_file_content(name)
-            source = CSVSource(name, csv_str)
+            source = CSVSource(name, name)
         elif typ == "json":
-            json_str = load_file_content(name)
-            source = JSONSource(name, json_str)
+            source = JSONSource(name, name)
         else:
             continue
         sources.append(source)
     
-    # Use enhanced function that includes full profile data for better display
-    results = recursive_match_with_full_profiles(base_profile, sources, llm, threshold=0.5)
+    # Include full profile data for better display
+    results = recursive_match(base_profile, sources, LLM, threshold=0.5,
+                              schema_agent=SCHEMA, matcher=MATCHER, include_full=True)
     
     # Return enhanced results with input information
     return jsonify({
@@ -1,58 +1,732 @@
-import os, json, sqlite3, csv, io
-from typing import List, Dict, Any
+import os, sqlite3, csv, json
+import logging
+import time
+import random
+import hashlib
+import threading
+import queue
+import atexit
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator, Callable, Hashable
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from google import generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
+import ijson
+import orjson
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
 import sqlite3
 import re
 import ast  # add this at the top
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+_DUMPS_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+
+
+def _dumps(obj: Any) -> str:
+    """Canonical compact JSON (sorted keys), used in prompts and cache keys."""
+    return orjson.dumps(obj, option=_DUMPS_OPTIONS).decode()
+
+
+def _load_json_file(raw: bytes) -> Any:
+    """
+    orjson.loads with a stdlib fallback, so data files using the NaN and
+    Infinity literals that json.loads accepts (and orjson rejects) still load.
+    """
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return json.loads(raw)
+
+
+# Fenced ```json block holding an object (first one) or an array (whole span)
+_JSON_BLOCK_RE = re.compile(r'```(?:json)?\s*(\{.*?\}|\[.*\])\s*```', re.DOTALL)
+
+
+def _extract_json(resp: str) -> Any:
+    """
+    Parses the JSON payload of an LLM response: the fenced ```json block if
+    there is one, otherwise the outermost {...} or [...] span. Falls back to
+    ast.literal_eval for Python-style literals (e.g. single quotes).
+    Raises ValueError or SyntaxError if nothing parses.
+    """
+    match = _JSON_BLOCK_RE.search(resp)
+    text = (match.group(1) if match else resp).strip()
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if starts:
+        start = min(starts)
+        end = text.rfind("}" if text[start] == "{" else "]")
+        if end > start:
+            text = text[start:end + 1]
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return ast.literal_eval(text)
+
+
+def _is_json_object(resp: str) -> bool:
+    """Response validator for LLMClient.generate(): the payload parses to a dict."""
+    try:
+        return isinstance(_extract_json(resp), dict)
+    except (ValueError, SyntaxError):
+        return False
+
+
+# Character n-gram hashing embedder: stateless, needs no model download and
+# rows come out L2-normalized, so cosine similarity is a plain dot product.
+_EMBEDDER = HashingVectorizer(
+    analyzer="char_wb", ngram_range=(3, 5), n_features=2 ** 12,
+    alternate_sign=False, norm="l2",
+)
+
+
+# Narrower embedder for whole-profile vectors, of which a source can have
+# many thousands; it only has to rank candidates, not separate prompts.
+_PROFILE_EMBEDDER = HashingVectorizer(
+    analyzer="char_wb", ngram_range=(2, 4), n_features=2 ** 10,
+    alternate_sign=False, norm="l2",
+)
+
+
+def _embed(texts: List[str], embedder: HashingVectorizer = _EMBEDDER) -> np.ndarray:
+    """Embed texts as L2-normalized float32 row vectors."""
+    return embedder.transform(texts).toarray().astype(np.float32)
+
+
+CACHE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_PATH = os.path.join(CACHE_DIR, "cache.db")
+
+
+class SQLiteStore:
+    """
+    String key/value tables in one SQLite file, opened in WAL mode so readers
+    never block on writers. Connections are pooled rather than tied to a
+    thread, so the short-lived worker threads of each request reuse them
+    (and their statement caches); all are closed at interpreter exit.
+
+    Rows are stamped with their insert time. Every ``prune_every`` writes to
+    a table, all but its newest ``max_rows`` rows are deleted.
+    """
+    TABLES = ("responses", "alignments", "comparisons")
+    max_rows = 100_000
+    prune_every = 1_000
+
+    def __init__(self, path: str):
+        self.path = path
+        self._pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._writes = dict.fromkeys(self.TABLES, 0)
+        self._writes_lock = threading.Lock()
+        _STORES.add(self)
+        with self._conn() as conn:
+            for table in self.TABLES:
+                conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} "
+                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL DEFAULT 0)"
+                )
+                if "created" not in {col[1] for col in conn.execute(f"PRAGMA table_info({table})")}:
+                    # A table from before rows were stamped; its rows count as the oldest
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN created REAL NOT NULL DEFAULT 0")
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)")
+            conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-8192")  # 8 MiB page cache
+        return conn
+
+    @contextmanager
+    def _conn(self) -> Iterator[sqlite3.Connection]:
+        # One caller at a time per connection; the pool grows to the peak
+        # number of concurrent callers
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def close(self) -> None:
+        """Closes the idle pooled connections."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _table(self, table: str) -> str:
+        # Table names are interpolated into the SQL, so only known ones are allowed
+        if table not in self.TABLES:
+            raise ValueError(f"Unknown cache table: {table!r}")
+        return table
+
+    def get(self, table: str, key: str, max_age: Optional[float] = None) -> Optional[str]:
+        entry = self.get_entry(table, key, max_age)
+        return entry[0] if entry else None
+
+    def get_entry(self, table: str, key: str,
+                  max_age: Optional[float] = None) -> Optional[Tuple[str, float]]:
+        """(value, age in seconds) of a row, or None if it is missing or older than ``max_age``."""
+        with self._conn() as conn:
+            row = conn.execute(
+                f"SELECT value, created FROM {self._table(table)} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        age = time.time() - row[1]
+        if max_age is not None and age > max_age:
+            return None
+        return row[0], age
+
+    def put(self, table: str, key: str, value: str) -> None:
+        with self._conn() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self._table(table)} (key, value, created) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            conn.commit()
+        with self._writes_lock:
+            self._writes[table] += 1
+            due = self._writes[table] % self.prune_every == 0
+        if due:
+            self.prune(table)
+
+    def prune(self, table: str, max_age: Optional[float] = None) -> None:
+        """Deletes rows older than ``max_age`` seconds and all but the newest ``max_rows``."""
+        table = self._table(table)
+        with self._conn() as conn:
+            if max_age is not None:
+                conn.execute(f"DELETE FROM {table} WHERE created < ?", (time.time() - max_age,))
+            conn.execute(
+                f"DELETE FROM {table} WHERE key IN "
+                f"(SELECT key FROM {table} ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.max_rows,),
+            )
+            conn.commit()
+
+    def delete(self, table: str, key: str) -> None:
+        with self._conn() as conn:
+            conn.execute(f"DELETE FROM {self._table(table)} WHERE key = ?", (key,))
+            conn.commit()
+
+    def items(self, table: str) -> Iterator[Tuple[str, str]]:
+        """Yields (key, value) rows straight off the cursor."""
+        with self._conn() as conn:
+            yield from conn.execute(f"SELECT key, value FROM {self._table(table)}")
+
+
+# Every live store, so their connections can be closed at exit without the
+# atexit registry keeping discarded stores alive
+_STORES: "weakref.WeakSet[SQLiteStore]" = weakref.WeakSet()
+
+
+@atexit.register
+def _close_stores() -> None:
+    for store in list(_STORES):
+        store.close()
+
+
+class LRUDict:
+    """
+    Minimal thread-safe mapping that keeps only the ``max_size`` most
+    recently used entries. For agent caches that live as long as the app.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def _prompt_key(prompt: str) -> str:
+    """Stable (process-independent) cache key for a prompt."""
+    return hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class PromptCache:
+    """
+    Bounded LRU + TTL cache of LLM responses.
+
+    Lookups first try an exact prompt match, in memory and then in the
+    optional SQLiteStore (which survives process restarts, e.g. Flask debug
+    reloads). If a similarity threshold is set, a miss falls back to the
+    cached prompt with the highest cosine similarity, computed as a single
+    matrix-vector product over the pre-normalized embedding matrix. The TTL
+    applies to both tiers, counted from when the response was first stored;
+    expired store rows are deleted when the cache is created. Safe to share
+    between threads.
+    """
+    def __init__(self, max_size: int = 10_000, ttl: float = 3600.0,
+                 threshold: Optional[float] = None, store: Optional[SQLiteStore] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        # prompt key -> (response, inserted_at, embedding row)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # Embedding rows are only kept with a threshold; the matrix starts empty
+        # and doubles as entries arrive, up to max_size rows
+        self._emb = (
+            np.zeros((0, _EMBEDDER.n_features), dtype=np.float32)
+            if threshold is not None else None
+        )
+        self._slot_keys: List[Optional[str]] = []
+        self._free: List[int] = []
+        self._lock = threading.Lock()
+        self._store = store
+        if store is not None:
+            store.prune("responses", max_age=ttl)
+
+    def get(self, prompt: str) -> Optional[str]:
+        key = _prompt_key(prompt)
+        with self._lock:
+            hit = self._lookup(key)
+        if hit is not None:
+            return hit
+
+        if self._store is not None:
+            entry = self._store.get_entry("responses", key, max_age=self.ttl)
+            if entry is not None:
+                hit, age = entry
+                emb = _embed([prompt])[0] if self._emb is not None else None
+                with self._lock:
+                    self._remember(key, hit, emb, age)
+                return hit
+
+        if self._emb is None:
+            return None
+        query = _embed([prompt])[0]
+        with self._lock:
+            if not self._entries:
+                return None
+            sims = self._emb @ query
+            slot = int(sims.argmax())
+            if sims[slot] > self.threshold and self._slot_keys[slot] is not None:
+                return self._lookup(self._slot_keys[slot])
+        return None
+
+    def put(self, prompt: str, response: str) -> None:
+        key = _prompt_key(prompt)
+        emb = _embed([prompt])[0] if self._emb is not None else None
+        with self._lock:
+            self._remember(key, response, emb)
+        if self._store is not None:
+            self._store.put("responses", key, response)
+
+    def discard(self, prompt: str) -> None:
+        """Forgets the response cached for ``prompt``, in memory and in the store."""
+        key = _prompt_key(prompt)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+        if self._store is not None:
+            self._store.delete("responses", key)
+
+    def _remember(self, key: str, response: str, emb: Optional[np.ndarray], age: float = 0.0) -> None:
+        if key in self._entries:
+            self._drop(key)
+        if len(self._entries) >= self.max_size:
+            self._drop(next(iter(self._entries)))
+        if not self._free:
+            self._grow()
+        slot = self._free.pop()
+        if emb is not None:
+            self._emb[slot] = emb
+        self._slot_keys[slot] = key
+        self._entries[key] = (response, time.monotonic() - age, slot)
+
+    def _grow(self) -> None:
+        old = len(self._slot_keys)
+        new = min(self.max_size, max(64, old * 2))
+        if self._emb is not None:
+            emb = np.zeros((new, self._emb.shape[1]), dtype=np.float32)
+            emb[:old] = self._emb
+            self._emb = emb
+        self._slot_keys.extend([None] * (new - old))
+        self._free.extend(range(new - 1, old - 1, -1))
+
+    def _lookup(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        response, inserted_at, _ = entry
+        if time.monotonic() - inserted_at > self.ttl:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def _drop(self, key: str) -> None:
+        _, _, slot = self._entries.pop(key)
+        if self._emb is not None:
+            self._emb[slot] = 0.0
+        self._slot_keys[slot] = None
+        self._free.append(slot)
+
+
+# GenerativeModel objects by name, shared by every LLMClient; genai is
+# configured once per API key
+_models: Dict[str, Any] = {}
+_models_lock = threading.Lock()
+_configured_key: Optional[str] = None
+
+
+def _generative_model(api_key: str, name: str) -> Any:
+    global _configured_key
+    with _models_lock:
+        if _configured_key != api_key:
+            genai.configure(api_key=api_key)
+            _configured_key = api_key
+            _models.clear()
+        model = _models.get(name)
+        if model is None:
+            model = _models[name] = genai.GenerativeModel(name)
+        return model
+
+
 class LLMClient:
     """
     Wraps the Google Gemini (GenAI) client. Loads the GEMINI_API_KEY from .env.
+
+    Responses are cached in a PromptCache. Semantic (near-duplicate) lookups
+    are off unless ``semantic_threshold`` is given: the prompts built by the
+    agents share long fixed templates, so two prompts can be very similar
+    while differing in exactly the field values that decide the answer.
+    Exact hits are persisted to ``cache_path`` (pass None to keep the cache
+    in memory only).
+
+    At most ``max_concurrency`` requests are in flight at once, across all
+    threads. Calls are also held back to ``rpm_limit`` requests and
+    ``tpm_limit`` tokens per rolling minute, and a rate-limit (429) error is
+    retried with exponential backoff, up to ``max_attempts`` tries in all.
     """
-    def __init__(self, model: str = "gemini-2.0-flash"):
-        load_dotenv()
+    def __init__(self, model: str = "gemini-2.0-flash",
+                 semantic_threshold: Optional[float] = None,
+                 cache_size: int = 10_000,
+                 cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+                 max_concurrency: int = 8,
+                 rpm_limit: int = 60,
+                 tpm_limit: int = 100_000,
+                 max_attempts: int = 3):
         self.api_key = os.getenv("GOOGLE_API_KEY")
         if not self.api_key:
             raise ValueError("GOOGLE_API_KEY not set in environment")
-        
-        # Configure the API
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel(model)
+        self.model = _generative_model(self.api_key, model)
+        self.cache = PromptCache(max_size=cache_size, threshold=semantic_threshold,
+                                 store=SQLiteStore(cache_path) if cache_path else None)
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.max_attempts = max_attempts
+        self.tokens_used = 0
+        # Request start times and (time, tokens) pairs within the last minute
+        self._requests: "deque[float]" = deque()
+        self._token_log: "deque[Tuple[float, int]]" = deque()
+        self._window_tokens = 0
+        self._rate_lock = threading.Lock()
 
-    def generate(self, prompt: str) -> str:
+    def generate(self, prompt: str, json_mode: bool = False,
+                 response_schema: Optional[Dict[str, Any]] = None,
+                 validate: Optional[Callable[[str], bool]] = None) -> str:
         """
-        Generates text using the LLM with the given prompt.
+        Generates text using the LLM with the given prompt. With ``json_mode``
+        (implied by ``response_schema``) Gemini answers in bare JSON, shaped
+        by the schema if one is given.
+
+        Pass ``validate`` to cache only responses the caller can use: a
+        response it rejects (a refusal, truncated or unparseable output) is
+        still returned but not cached, so the next call asks again. Cached
+        responses it rejects are evicted and asked again.
         """
+        config, cache_text = self._request(prompt, json_mode, response_schema)
+        cached = self.cache.get(cache_text)
+        if cached is not None:
+            if validate is None or validate(cached):
+                return cached
+            self.cache.discard(cache_text)
         try:
-            response = self.model.generate_content(prompt)
+            for attempt in range(self.max_attempts):
+                while (delay := self._reserve()) > 0:
+                    time.sleep(delay)
+                try:
+                    with self._slots:
+                        response = self.model.generate_content(prompt, generation_config=config)
+                    break
+                except ResourceExhausted:
+                    if attempt + 1 == self.max_attempts:
+                        raise
+                    delay = self._backoff(attempt)
+                    logger.warning("⏳ Rate limited by Gemini, retrying in %.1fs", delay)
+                    time.sleep(delay)
+            self._record_usage(response)
             if response.text:
-                # print(response.text)
+                logger.debug("LLM response: %s", response.text)
+                if validate is None or validate(response.text):
+                    self.cache.put(cache_text, response.text)
                 return response.text
             else:
                 return ""
         except Exception as e:
-            print(f"Error generating text: {e}")
+            logger.error("Error generating text: %s", e)
             return ""
 
+    @staticmethod
+    def _request(prompt: str, json_mode: bool,
+                 response_schema: Optional[Dict[str, Any]]) -> Tuple[Optional[Dict[str, Any]], str]:
+        """The generation config for a call, and the text its response is cached under."""
+        if not json_mode and response_schema is None:
+            return None, prompt
+        config: Dict[str, Any] = {"response_mime_type": "application/json"}
+        if response_schema is not None:
+            config["response_schema"] = response_schema
+        # The same prompt under a different output contract is a different request
+        return config, f"{prompt}\0{_dumps(config)}"
+
+    def _reserve(self) -> float:
+        """
+        Claims a request slot in the current minute and returns 0, or returns
+        how long to wait before asking again if a per-minute budget is spent.
+        """
+        now = time.monotonic()
+        cutoff = now - 60.0
+        with self._rate_lock:
+            while self._requests and self._requests[0] <= cutoff:
+                self._requests.popleft()
+            while self._token_log and self._token_log[0][0] <= cutoff:
+                self._window_tokens -= self._token_log.popleft()[1]
+            waits = []
+            if len(self._requests) >= self.rpm_limit:
+                waits.append(self._requests[0] - cutoff)
+            if self._token_log and self._window_tokens >= self.tpm_limit:
+                waits.append(self._token_log[0][0] - cutoff)
+            if waits:
+                return max(waits)
+            self._requests.append(now)
+            return 0.0
+
+    def _record_usage(self, response: Any) -> None:
+        usage = getattr(response, "usage_metadata", None)
+        tokens = getattr(usage, "total_token_count", 0) or 0
+        if not tokens:
+            return
+        with self._rate_lock:
+            self._token_log.append((time.monotonic(), tokens))
+            self._window_tokens += tokens
+            self.tokens_used += tokens
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        # 1s, 2s, 4s, ... capped at 30s, plus jitter so pooled threads spread out
+        return min(30.0, 2.0 ** attempt) + random.uniform(0.0, 1.0)
+
+
+
+# Standard profile field names and the variations they are known by. Used by
+# the NL preprocessor to standardize extracted keys and by the schema aligner
+# to recognise synonymous column names.
+FIELD_SYNONYMS: Dict[str, List[str]] = {
+    "name": ["name", "full_name", "fullname", "first_name", "last_name", "given_name", "surname", "customer_name"],
+    "dob": ["dob", "date_of_birth", "birth_date", "birthdate", "born"],
+    "id": ["id", "customer_id", "cust_id", "user_id", "account_id", "employee_id", "emp_id", "identification", "identifier"],
+    "phone": ["phone", "phone_number", "phone_no", "mobile", "mobile_number", "cell", "telephone", "contact"],
+    "email": ["email", "email_address", "email_id", "mail", "e_mail"],
+    "address": ["address", "addr", "street_address", "location", "residence", "home", "city", "state", "country"],
+    "bank_id": ["bank_id", "bank_account", "account_number", "banking_id"],
+    "passport": ["passport", "passport_number", "passport_id"],
+    "ssn": ["ssn", "social_security", "social_security_number"],
+    "nationality": ["nationality", "citizenship", "country_of_birth"],
+    "occupation": ["occupation", "job", "profession", "work", "employment"],
+    "company": ["company", "employer", "organization", "firm", "workplace"]
+}
+
+_FIELD_GROUPS: Dict[str, str] = {
+    variation: standard for standard, variations in FIELD_SYNONYMS.items() for variation in variations
+}
+
+
+# Schema alignment leaves out the names that only label part of an address:
+# as columns they hold a fragment ("USA"), not something to match an address on
+_ADDRESS_PARTS = {"city", "state", "country"}
+_ALIGN_GROUPS: Dict[str, str] = {
+    variation: standard for variation, standard in _FIELD_GROUPS.items() if variation not in _ADDRESS_PARTS
+}
+
+
+def _normalize_field_name(field_name: str) -> str:
+    return field_name.lower().strip().replace("-", "_").replace(" ", "_")
 
 
 class SchemaDetectorAgent:
-    def __init__(self, llm: LLMClient):
+    # Minimum score for a field match; same-group pairs always clear it
+    align_threshold = 0.55
+    # Minimum cosine similarity for names that don't share a FIELD_SYNONYMS group
+    ungrouped_threshold = 0.75
+
+    def __init__(self, llm: LLMClient, use_llm: bool = False,
+                 cache_path: Optional[str] = DEFAULT_CACHE_PATH):
         self.llm = llm
-        self.cache: Dict[str, List[str]] = {}
+        self.use_llm = use_llm
+        self.cache: Dict[Hashable, List[str]] = {}
+        self.align_cache: Dict[Tuple[frozenset, frozenset], Dict[str, str]] = {}
+        self._field_emb_cache: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+        # field-set pair -> lock held while that pair's alignment is computed
+        self._pending: Dict[Tuple[frozenset, frozenset], threading.Lock] = {}
+        # LLM alignments are persisted so restarts don't repeat the call; local
+        # alignments are cheap to recompute and only cached in memory.
+        self._store = SQLiteStore(cache_path) if cache_path and use_llm else None
+        if self._store is not None:
+            for key, value in self._store.items("alignments"):
+                base, target = orjson.loads(key)
+                self.align_cache[(frozenset(base), frozenset(target))] = orjson.loads(value)
 
     def detect(self, source: "DataSource") -> List[str]:
-        if source.name in self.cache:
-            return self.cache[source.name]
+        key = source.cache_key()
+        with self._lock:
+            if key in self.cache:
+                return self.cache[key]
         fields = source.infer_schema()
-        self.cache[source.name] = fields
+        with self._lock:
+            self.cache[key] = fields
         return fields
 
     def align(self, base: List[str], target: List[str]) -> Dict[str, str]:
+        """
+        Maps target field names to base field names (target → base).
+
+        Field names are embedded once and cached; one matrix product gives
+        every target×base cosine similarity. Names belonging to the same
+        FIELD_SYNONYMS group (e.g. 'dob' and 'birth_date') get a bonus, and
+        pairs are then assigned greedily, best first, each field at most once.
+        With ``use_llm``, target fields left unmatched are then sent to the
+        LLM, together with the base fields still free.
+
+        Results are cached by the (unordered) pair of field sets, and a target
+        with exactly the base's fields maps onto itself without any lookup.
+        Concurrent calls for the same pair compute it once; the others wait
+        for that result.
+        """
+        key = (frozenset(base), frozenset(target))
+        if key[0] == key[1]:
+            return {f: f for f in target}
+        cached = self.align_cache.get(key)
+        if cached is not None:
+            return dict(cached)
+
+        with self._lock:
+            pending = self._pending.setdefault(key, threading.Lock())
+        with pending:
+            try:
+                cached = self.align_cache.get(key)
+                if cached is not None:
+                    return dict(cached)
+                return self._align_uncached(base, target, key)
+            finally:
+                with self._lock:
+                    self._pending.pop(key, None)
+
+    def _align_uncached(self, base: List[str], target: List[str],
+                        key: Tuple[frozenset, frozenset]) -> Dict[str, str]:
+        mapping = self._align_local(base, target)
+        if self.use_llm:
+            rest_target = [f for f in target if f not in mapping]
+            used = set(mapping.values())
+            rest_base = [f for f in base if f not in used]
+            if rest_target and rest_base:
+                extra = self._align_llm(rest_base, rest_target)
+                if extra is None:
+                    return mapping  # LLM or parsing failure; don't pin it
+                for t, b in extra.items():
+                    if t in rest_target and b in rest_base and b not in used:
+                        mapping[t] = b
+                        used.add(b)
+        with self._lock:
+            self.align_cache[key] = mapping
+        if self._store is not None:
+            self._store.put(
+                "alignments",
+                _dumps([sorted(key[0]), sorted(key[1])]),
+                _dumps(mapping),
+            )
+        return dict(mapping)
+
+    def _align_local(self, base: List[str], target: List[str]) -> Dict[str, str]:
+        if not base or not target:
+            return {}
+
+        self._embed_fields(list(base) + list(target))
+        B = np.stack([self._field_emb_cache[f] for f in base])
+        T = np.stack([self._field_emb_cache[f] for f in target])
+        sims = T @ B.T
+
+        base_names = np.array([_normalize_field_name(f) for f in base])
+        target_names = np.array([_normalize_field_name(f) for f in target])
+        base_groups = np.array([_ALIGN_GROUPS.get(n, "") for n in base_names])
+        target_groups = np.array([_ALIGN_GROUPS.get(n, "") for n in target_names])
+        grouped = (target_groups[:, None] != "") & (base_groups[None, :] != "")
+        same_group = grouped & (target_groups[:, None] == base_groups[None, :])
+        # Identical names rank above other members of the same group
+        exact = target_names[:, None] == base_names[None, :]
+        scores = sims + same_group + 0.5 * exact
+        # Names in different groups never match, and names without a shared
+        # group only when they are close ('dob' is not 'nationality' just
+        # because 'national_id' resembles it)
+        scores[grouped & ~same_group] = -1.0
+        scores[~same_group & ~exact & (sims < self.ungrouped_threshold)] = -1.0
+
+        mapping: Dict[str, str] = {}
+        used_base = set()
+        for flat in np.argsort(-scores, axis=None, kind="stable"):
+            i, j = divmod(int(flat), len(base))
+            if scores[i, j] <= self.align_threshold:
+                break
+            if target[i] in mapping or j in used_base:
+                continue
+            mapping[target[i]] = base[j]
+            used_base.add(j)
+        return mapping
+
+    def _embed_fields(self, fields: List[str]) -> None:
+        missing = [f for f in dict.fromkeys(fields) if f not in self._field_emb_cache]
+        if not missing:
+            return
+        texts = []
+        for f in missing:
+            name = _normalize_field_name(f)
+            group = _ALIGN_GROUPS.get(name)
+            words = name.replace("_", " ")
+            texts.append(f"{group} {words}" if group else words)
+        for f, emb in zip(missing, _embed(texts)):
+            self._field_emb_cache[f] = emb
+
+    def _align_llm(self, base: List[str], target: List[str]) -> Optional[Dict[str, str]]:
+        """The LLM's target → base mapping, or None if its response can't be used."""
         prompt = (
             "You are an expert data engineer with deep experience in data integration, "
             "heterogeneous data systems, and intelligent schema alignment.\n"
@@ -60,8 +734,8 @@ class SchemaDetectorAgent:
             "to a base schema, even when naming conventions differ, fields are reordered, "
             "or contain domain-specific terminology.\n\n"
             "Given:\n"
-            f"🔹 Base Schema Fields (reference): {base}\n"
-            f"🔹 Target Schema Fields (to align): {target}\n\n"
+            f"🔹 Base Schema Fields (reference): {sorted(base)}\n"
+            f"🔹 Target Schema Fields (to align): {sorted(target)}\n\n"
             "Instructions:\n"
             "- Map each field in the TARGET schema to its most likely equivalent in the BASE schema.\n"
             "- The mapping should be based on semantic meaning, common synonyms, and domain context (e.g., 'dob' ↔ 'birth_date').\n"
@@ -69,55 +743,87 @@ class SchemaDetectorAgent:
             "- Do NOT include base fields that are not matched by any target field.\n\n"
             "Return JSON mapping from target → base."
         )
-        resp = self.llm.generate(prompt)
+        # Gemini's response schemas can't express an open string->string map,
+        # so only the JSON output mode is requested here
+        resp = self.llm.generate(prompt, json_mode=True, validate=_is_json_object)
 
         try:
-            # Try extracting JSON inside triple backticks (```json ... ```)
-            match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', resp, re.DOTALL)
-            json_str = match.group(1) if match else resp.strip()
-
-            print("🔍 Raw extracted JSON:\n", json_str)
-
-            # First, try standard JSON parsing
-            return json.loads(json_str)
-        except json.JSONDecodeError as e:
-            print(f"⚠️ json.loads failed: {e}")
-            try:
-                # Try using ast.literal_eval as fallback for non-standard JSON (e.g. single quotes)
-                return ast.literal_eval(json_str)
-            except Exception as e2:
-                print(f"❌ Failed to parse mapping even with ast.literal_eval: {e2}")
-                return {}
+            mapping = _extract_json(resp)
+        except (ValueError, SyntaxError) as e:
+            logger.warning("❌ Failed to parse mapping: %s", e)
+            return None
+        return mapping if isinstance(mapping, dict) else None
 
 
 class Profile:
     def __init__(self, data: Dict[str, Any]):
         self.data = data
 
+    @property
+    def data(self) -> Dict[str, Any]:
+        return self._data
+
+    @data.setter
+    def data(self, data: Dict[str, Any]) -> None:
+        self._data = data
+        self._json: Optional[str] = None
+
+    @property
+    def json(self) -> str:
+        """Canonical JSON of ``data``, built once. Edit fields via update() to keep it current."""
+        if self._json is None:
+            self._json = _dumps(self._data)
+        return self._json
+
+    def update(self, fields: Dict[str, Any]) -> None:
+        self._data.update(fields)
+        self._json = None
+
+
+# Deterministic extractors for fields with a fixed shape, applied in order;
+# each match is blanked out of the text before the next pattern runs.
+_FIELD_PATTERNS = [
+    ("email", re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")),
+    ("ssn", re.compile(r"\b\d{3}-\d{2}-\d{4}\b")),
+    # Dates and digit runs are only taken when labelled: an unlabelled number
+    # may as well be an ID, an account or an Aadhaar number
+    ("dob", re.compile(
+        r"\b(?:dob|d\.o\.b\.?|born(?:\s+on)?|birth\s*date|date\s+of\s+birth)(?:\s+is|\s*[:#])?"
+        r"\s+((?:19|20)\d{2}-\d{2}-\d{2})\b", re.IGNORECASE)),
+    # Only the label is case-insensitive: the number itself is upper-case and
+    # holds a digit, so "passport number" or "passport expired" is no match
+    ("passport", re.compile(
+        r"\b(?i:passport(?:\s+(?:number|no\.?|id))?(?:\s+is|\s*[:#])?)"
+        r"\s+((?=[A-Z0-9]*\d)[A-Z0-9]{6,9})\b")),
+    ("phone", re.compile(
+        r"\b(?:phone|mobile|cell|telephone|tel)(?:\s+(?:number|no\.?))?(?:\s+is|\s*[:#])?"
+        r"\s+(\+?\d[\d\s().-]{8,}\d)(?![\w-])", re.IGNORECASE)),
+]
+_WORD_RE = re.compile(r"[a-z0-9]+")
+# Filler and the labels of the fields above: a residual made only of these
+# words holds nothing for the LLM to extract. Words that can be values
+# ("state", "bank", "home", ...) must not be listed here.
+_LABEL_WORDS = {
+    "a", "an", "and", "are", "at", "born", "by", "details", "dob", "e", "email", "find", "for",
+    "her", "his", "is", "look", "mail", "me", "mobile", "my", "no", "number", "of", "on", "or",
+    "passport", "person", "phone", "search", "security", "social", "ssn", "the", "their", "up", "with",
+}
+
 
 class NLPreprocessorAgent:
     """
     Agent 0: Natural Language Preprocessor
     Extracts structured profile information from natural language queries.
+
+    Fixed-shape fields (email, SSN, ISO dates of birth, passport, phone) are
+    pulled out with regexes first; the LLM is only asked for what is left,
+    and skipped entirely when nothing but those values and label words remain.
     """
     
     def __init__(self, llm: LLMClient):
         self.llm = llm
         # Define supported field types for dynamic extraction
-        self.supported_fields = {
-            "name": ["name", "full_name", "first_name", "last_name", "given_name", "surname"],
-            "dob": ["dob", "date_of_birth", "birth_date", "birthdate", "born"],
-            "id": ["id", "customer_id", "user_id", "account_id", "identification", "identifier"],
-            "phone": ["phone", "phone_number", "mobile", "cell", "telephone", "contact"],
-            "email": ["email", "email_address", "mail", "e_mail"],
-            "address": ["address", "location", "residence", "home", "city", "state", "country"],
-            "bank_id": ["bank_id", "bank_account", "account_number", "banking_id"],
-            "passport": ["passport", "passport_number", "passport_id"],
-            "ssn": ["ssn", "social_security", "social_security_number"],
-            "nationality": ["nationality", "citizenship", "country_of_birth"],
-            "occupation": ["occupation", "job", "profession", "work", "employment"],
-            "company": ["company", "employer", "organization", "firm", "workplace"]
-        }
+        self.supported_fields = FIELD_SYNONYMS
 
     def extract_profile(self, natural_language_query: str) -> Dict[str, Any]:
         """
@@ -130,6 +836,10 @@ class NLPreprocessorAgent:
             Dictionary with extracted fields in clean JSON format
         """
         
+        extracted, residual = self._extract_deterministic(natural_language_query)
+        if not any(word not in _LABEL_WORDS for word in _WORD_RE.findall(residual.lower())):
+            return self._clean_extracted_data(extracted)
+
         # Create field descriptions for the prompt
         field_descriptions = []
         for field_type, variations in self.supported_fields.items():
@@ -144,6 +854,8 @@ SUPPORTED FIELD TYPES:
 
 INPUT TEXT: "{natural_language_query}"
 
+PRE-EXTRACTED BY PATTERN (may be omitted from your answer if correct; include the field if the text says otherwise): {_dumps(extracted) if extracted else "none"}
+
 EXTRACTION RULES:
 1. Extract ONLY the information that is explicitly mentioned in the text
 2. Use standardized field names (name, dob, id, phone, email, address, bank_id, passport, ssn, nationality, occupation, company)
@@ -165,47 +877,45 @@ EXAMPLE OUTPUT FORMAT:
 Extract the profile information and respond with ONLY the JSON object:"""
 
         try:
-            response = self.llm.generate(prompt)
+            response = self.llm.generate(prompt, json_mode=True, validate=_is_json_object)
             
             # Clean and parse the JSON response
-            return self._parse_json_response(response)
+            profile = self._parse_json_response(response)
             
         except Exception as e:
-            print(f"❌ Error in NL extraction: {e}")
-            return {}
+            logger.error("❌ Error in NL extraction: %s", e)
+            profile = {}
+        # Pattern matches only fill fields the LLM left empty
+        for key, value in self._clean_extracted_data(extracted).items():
+            if profile.get(key) in (None, "", []):
+                profile[key] = value
+        return profile
+
+    @staticmethod
+    def _extract_deterministic(text: str) -> Tuple[Dict[str, str], str]:
+        """Returns the regex-extracted fields and the text left over."""
+        extracted: Dict[str, str] = {}
+        for field, pattern in _FIELD_PATTERNS:
+            match = pattern.search(text)
+            if field == "phone":
+                # Require a plausible number of digits, not just any digit run
+                while match and not 10 <= sum(c.isdigit() for c in match.group(1)) <= 15:
+                    match = pattern.search(text, match.end())
+            if match:
+                extracted[field] = (match.group(1) if pattern.groups else match.group(0)).strip()
+                text = text[:match.start()] + " " + text[match.end():]
+        return extracted, text
 
     def _parse_json_response(self, response: str) -> Dict[str, Any]:
         """Parse and clean JSON response from LLM"""
         try:
-            # Try extracting JSON inside triple backticks first
-            match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', response, re.DOTALL)
-            json_str = match.group(1) if match else response.strip()
-            
-            # Remove any leading/trailing whitespace and non-JSON content
-            json_str = json_str.strip()
-            
-            # Find the first { and last } to extract clean JSON
-            start_idx = json_str.find('{')
-            end_idx = json_str.rfind('}')
-            
-            if start_idx != -1 and end_idx != -1:
-                json_str = json_str[start_idx:end_idx+1]
-            
-            # Try standard JSON parsing
-            parsed_data = json.loads(json_str)
-            
-            # Clean and validate the extracted data
-            return self._clean_extracted_data(parsed_data)
-            
-        except json.JSONDecodeError:
-            try:
-                # Fallback to ast.literal_eval for single-quoted JSON
-                parsed_data = ast.literal_eval(json_str)
-                return self._clean_extracted_data(parsed_data)
-            except Exception as e:
-                print(f"⚠️ Failed to parse NL extraction response: {e}")
-                print(f"Raw response: {response}")
-                return {}
+            parsed_data = _extract_json(response)
+        except (ValueError, SyntaxError) as e:
+            logger.warning("⚠️ Failed to parse NL extraction response: %s", e)
+            logger.debug("Raw response: %s", response)
+            return {}
+        # Clean and validate the extracted data
+        return self._clean_extracted_data(parsed_data) if isinstance(parsed_data, dict) else {}
 
     def _clean_extracted_data(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Clean and normalize extracted profile data"""
@@ -232,13 +942,8 @@ Extract the profile information and respond with ONLY the JSON object:"""
     def _standardize_field_name(self, field_name: str) -> str:
         """Map field variations to standard field names"""
         field_name = field_name.lower().strip().replace(' ', '_')
-        
-        for standard_name, variations in self.supported_fields.items():
-            if field_name in [v.lower().replace(' ', '_') for v in variations]:
-                return standard_name
-        
         # If no exact match, return the original field name
-        return field_name
+        return _FIELD_GROUPS.get(field_name, field_name)
 
     def create_profile_from_nl(self, natural_language_query: str) -> Profile:
         """
@@ -254,163 +959,483 @@ Extract the profile information and respond with ONLY the JSON object:"""
         return Profile(extracted_data)
 
 
+def chunked(items: List[Any], size: int):
+    """Yield successive ``size``-long slices of ``items``."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _profile_text(data: Dict[str, Any]) -> str:
+    return " ".join(str(data[k]) for k in sorted(data, key=str) if data[k] not in (None, ""))
+
+
+def _signature(text: str) -> int:
+    """64-bit Bloom-style signature: one bit per distinct alphanumeric character."""
+    sig = 0
+    for c in set(text.lower()):
+        if c.isalnum():
+            sig |= 1 << (ord(c) % 64)
+    return sig
+
+
 class ProfileMatchingAgent:
-    def __init__(self, llm: LLMClient):
+    # Candidates per LLM call; larger batches save requests but slow each
+    # response and dilute the model's attention on individual rows
+    batch_size = 10
+    # Only this many nearest candidates per source are sent to the LLM
+    prefilter_k = 20
+    # Shape of the batch scoring response, enforced by Gemini's JSON mode
+    response_schema = {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "id": {"type": "INTEGER"},
+                "score": {"type": "NUMBER"},
+                "reason": {"type": "STRING"},
+            },
+            "required": ["id", "score", "reason"],
+        },
+    }
+    # Candidates sharing less than this fraction of the smaller signature's
+    # bits with the base (and always those sharing none) are rejected without
+    # an LLM call. Kept low: name variants like "J. Smyth" / "John Smith" or
+    # "Muhammad" / "Mohammed" share only about half their characters.
+    min_overlap = 0.25
+    # (source, mapping) slots whose prefilter index and signatures are kept
+    index_slots = 32
+
+    def __init__(self, llm: LLMClient, cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+                 cache_size: int = 10_000):
         self.llm = llm
+        # slot -> (version, index); one index per source/mapping, rebuilt when
+        # the source changes. Each holds a matrix per source, so only the
+        # ``index_slots`` most recently used are kept.
+        self._indexes = LRUDict(self.index_slots)
+        self._signatures = LRUDict(self.index_slots)
+        # (base, candidate) content hash -> parsed result, so a pair is scored
+        # once whatever batch it lands in; persisted to ``cache_path``, and the
+        # ``cache_size`` most recent kept in memory
+        self.cache = LRUDict(cache_size)
+        self._store = SQLiteStore(cache_path) if cache_path else None
+
+    def build_index(self, profiles: List[Dict[str, Any]]) -> np.ndarray:
+        """Stacks the L2-normalized embeddings of the profiles' values into an (n, d) matrix."""
+        return _embed([_profile_text(p) for p in profiles], _PROFILE_EMBEDDER)
+
+    def overlapping(self, base: Profile, profiles: List[Dict[str, Any]],
+                    slot: Optional[Hashable] = None, version: Optional[Hashable] = None) -> List[int]:
+        """
+        Indices of the profiles whose signature overlaps enough with ``base``'s.
+        ``slot``/``version`` reuse the signatures computed on an earlier call,
+        as for nearest().
+        """
+        cached = self._signatures.get(slot) if slot is not None else None
+        if cached is not None and cached[0] == version:
+            sigs = cached[1]
+        else:
+            sigs = np.array([_signature(_profile_text(p)) for p in profiles], dtype=np.uint64)
+            if slot is not None:
+                self._signatures[slot] = (version, sigs)
+        base_sig = _signature(_profile_text(base.data))
+        base_bits = bin(base_sig).count("1")
+        if not base_bits:
+            return list(range(len(profiles)))
+
+        def popcount(a: np.ndarray) -> np.ndarray:
+            # Of every element at once: unpack each uint64 into its 64 bits
+            return np.unpackbits(a.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+        common = popcount(sigs & np.uint64(base_sig))
+        need = np.maximum(1, np.ceil(self.min_overlap * np.minimum(popcount(sigs), base_bits)))
+        return np.flatnonzero(common >= need).tolist()
+
+    def nearest(self, base: Profile, profiles: List[Dict[str, Any]],
+                slot: Optional[Hashable] = None, version: Optional[Hashable] = None,
+                among: Optional[List[int]] = None) -> List[int]:
+        """
+        Indices of the ``prefilter_k`` profiles most similar to ``base``, best
+        first, optionally only considering the indices in ``among``. Pass
+        ``slot``/``version`` to reuse the index built for the same profiles on
+        an earlier call.
+        """
+        cached = self._indexes.get(slot) if slot is not None else None
+        if cached is not None and cached[0] == version:
+            index = cached[1]
+        else:
+            index = self.build_index(profiles)
+            if slot is not None:
+                self._indexes[slot] = (version, index)
+        ids = np.arange(len(profiles)) if among is None else np.asarray(among, dtype=np.intp)
+        sims = index[ids] @ _embed([_profile_text(base.data)], _PROFILE_EMBEDDER)[0]
+        k = self.prefilter_k
+        # Partial selection of the top k in O(n), then sort just those
+        top = np.argpartition(-sims, k - 1)[:k] if len(sims) > k else np.arange(len(sims))
+        return ids[top[np.argsort(-sims[top], kind="stable")]].tolist()
 
     def compare(self, base: Profile, cand: Profile) -> Dict[str, Any]:
-        prompt = (
+        return self.compare_batch(base, [cand.data])[0]
+
+    def compare_batch(self, base: Profile, candidates: List[Dict[str, Any]],
+                      batch_size: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Scores candidate dicts against ``base``, ``batch_size`` candidates per
+        LLM call; pairs scored before are answered from the cache. Returns one
+        {"score", "reason"} dict per candidate, in input order.
+        """
+        keys, results = self._lookup(base, candidates)
+        misses = [i for i, res in enumerate(results) if res is None]
+        for chunk in chunked(misses, batch_size or self.batch_size):
+            resp = self.llm.generate(
+                self._batch_prompt(base, [candidates[i] for i in chunk]),
+                response_schema=self.response_schema,
+                # Cache the batch only if every candidate got a result
+                validate=lambda r, n=len(chunk): None not in self._parse_batch(r, n),
+            )
+            self._fill(results, keys, chunk, resp)
+        return results
+
+    def _lookup(self, base: Profile,
+                candidates: List[Dict[str, Any]]) -> Tuple[List[str], List[Optional[Dict[str, Any]]]]:
+        prefix = hashlib.sha1(base.json.encode("utf-8"))
+        keys, results = [], []
+        for cand in candidates:
+            h = prefix.copy()
+            h.update(b"\0" + _dumps(cand).encode("utf-8"))
+            key = h.hexdigest()
+            hit = self.cache.get(key)
+            if hit is None and self._store is not None:
+                raw = self._store.get("comparisons", key)
+                if raw is not None:
+                    hit = self.cache[key] = orjson.loads(raw)
+            keys.append(key)
+            results.append(dict(hit) if hit is not None else None)
+        return keys, results
+
+    def _fill(self, results: List[Optional[Dict[str, Any]]], keys: List[str],
+              chunk: List[int], resp: str) -> None:
+        for i, item in zip(chunk, self._parse_batch(resp, len(chunk))):
+            if item is None:
+                # Unparseable or missing from the response: not cached, so retried next time
+                results[i] = {"score": 0.0, "reason": resp}
+                continue
+            results[i] = dict(item)
+            self.cache[keys[i]] = item
+            if self._store is not None:
+                self._store.put("comparisons", keys[i], _dumps(item))
+
+    @staticmethod
+    def _batch_prompt(base: Profile, candidates: List[Dict[str, Any]]) -> str:
+        listing = "\n".join(
+            # Written by hand so "id" leads each line rather than sorting after "data"
+            f'{{"id": {i}, "data": {_dumps(cand)}}}' for i, cand in enumerate(candidates)
+        )
+        return (
             "You are an expert identity resolution engineer with deep experience in KYC, fraud detection, "
             "and profile matching across fragmented or incomplete data sources.\n\n"
-            "Your task is to analyze and compare two identity profiles to assess the likelihood that they refer "
-            "to the same real-world individual. These profiles may differ in formatting, field presence, or data quality.\n\n"
+            "Your task is to compare a base identity profile against each of the candidate profiles "
+            "and assess the likelihood that each candidate refers to the same real-world individual as the base. "
+            "These profiles may differ in formatting, field presence, or data quality.\n\n"
             "Instructions:\n"
             "- Carefully evaluate each shared field (e.g., name, email, DOB, phone, address, customer_id).\n"
             "- Weigh strong matches like exact name and DOB more heavily.\n"
             "- Missing fields should reduce confidence only slightly unless they are critical.\n"
             "- Consider fuzzy matches (e.g., email domain differences or name variants).\n"
-            "- Return your evaluation as a JSON object.\n\n"
+            "- Judge every candidate independently against the base profile.\n\n"
             "Input:\n"
-            f"🔹 Base Profile: {json.dumps(base.data)}\n"
-            f"🔹 Candidate Profile: {json.dumps(cand.data)}\n\n"
+            f"🔹 Base Profile: {base.json}\n"
+            f"🔹 Candidate Profiles (one JSON object per line, with the profile under \"data\"):\n{listing}\n\n"
             "Output Format:\n"
-            "{\n"
-            '  "score": float (between 0 and 1),\n'
-            '  "reason": "short explanation of your logic"\n'
-            "}\n\n"
-            "Respond ONLY with the JSON object. No extra explanation or markdown."
+            "Return a JSON array with one object per candidate:\n"
+            "[\n"
+            "  {\n"
+            '    "id": int (the candidate\'s id),\n'
+            '    "score": float (between 0 and 1),\n'
+            '    "reason": "short explanation of your logic"\n'
+            "  }\n"
+            "]\n\n"
+            "Respond ONLY with the JSON array. No extra explanation or markdown."
         )
-        # print(json.dumps(base.data))
-        # print(json.dumps(cand.data))
-        resp = self.llm.generate(prompt)
-        # print("\n📨 RAW LLM RESPONSE:\n", resp) 
+
+    @staticmethod
+    def _parse_batch(resp: str, count: int) -> List[Optional[Dict[str, Any]]]:
+        """One parsed result per candidate, None where the response had none."""
+        logger.debug("📨 Raw LLM response: %s", resp)
+        results: List[Optional[Dict[str, Any]]] = [None] * count
         try:
-            match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', resp, re.DOTALL)
-            json_str = match.group(1) if match else resp.strip()
-            return json.loads(json_str)
-        except:
-            return {"score": 0.0, "reason": resp}
+            items = _extract_json(resp)
+        except (ValueError, SyntaxError):
+            return results
+        for item in items if isinstance(items, list) else [items]:
+            if not isinstance(item, dict):
+                continue
+            # A lone candidate may come back as a bare object without an id
+            idx = item.pop("id", 0 if count == 1 else None)
+            if isinstance(idx, int) and 0 <= idx < len(results):
+                results[idx] = item
+        return results
 
 class DataSource(ABC):
     def __init__(self, name: str):
         self.name = name
 
+    def cache_key(self) -> Hashable:
+        """Identifies this source's current contents for schema caching."""
+        return self.name
+
     @abstractmethod
     def infer_schema(self) -> List[str]: ...
     @abstractmethod
-    def get_profiles(self) -> List[Profile]: ...
+    def get_profiles(self) -> Iterable[Profile]: ...
+
+    def iter_profiles_normalized(self, mapping: Dict[str, str],
+                                 fields: List[str]) -> Iterator[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """
+        Single pass over the source yielding (raw row, normalized row) pairs,
+        where the normalized row holds only the mapped fields renamed to the
+        base schema, in the order of ``fields`` (the schema the caller already
+        detected, so it is not inferred again). Sources override this to skip
+        the Profile wrappers.
+        """
+        normalize = _make_normalizer(mapping, fields)
+        for p in self.get_profiles():
+            yield p.data, normalize(p.data)
+
+# Read files in 1 MiB chunks instead of the 8 KiB default
+READ_BUFFER_SIZE = 1 << 20
+
 
 class CSVSource(DataSource):
-    def __init__(self, name: str, csv_str: str):
+    """Streams rows from a CSV file; only the header is kept between calls."""
+    def __init__(self, name: str, path: str):
         super().__init__(name)
-        self.csv_str = csv_str
+        self.path = path
+        self._schema: Optional[Tuple[Hashable, List[str]]] = None
+
+    def _open(self):
+        return open(self.path, "r", newline="", encoding="utf-8", buffering=READ_BUFFER_SIZE)
+
+    def cache_key(self):
+        return (self.path, os.stat(self.path).st_mtime_ns)
 
     def infer_schema(self):
-        reader = csv.DictReader(io.StringIO(self.csv_str))
-        return reader.fieldnames or []
+        # Memoized until the file changes; refreshed by every full read too
+        key = self.cache_key()
+        if self._schema is None or self._schema[0] != key:
+            with self._open() as f:
+                self._schema = (key, next(csv.reader(f), []))
+        return self._schema[1]
 
     def get_profiles(self):
-        reader = csv.DictReader(io.StringIO(self.csv_str))
-        return [Profile(dict(row)) for row in reader]
+        for row in self._iter_rows():
+            yield Profile(row)
+
+    def iter_profiles_normalized(self, mapping, fields):
+        normalize = _make_normalizer(mapping, fields)
+        for row in self._iter_rows():
+            yield row, normalize(row)
+
+    def _iter_rows(self):
+        # csv.reader + zip instead of DictReader, whose row handling is pure
+        # Python; ragged rows are padded/collected the way DictReader does.
+        with self._open() as f:
+            key = (self.path, os.fstat(f.fileno()).st_mtime_ns)
+            reader = csv.reader(f)
+            header = next(reader, None)
+            self._schema = (key, header or [])
+            if header is None:
+                return
+            width = len(header)
+            for row in reader:
+                if not row:
+                    continue
+                data = dict(zip(header, row))
+                if len(row) < width:
+                    data.update(dict.fromkeys(header[len(row):]))
+                elif len(row) > width:
+                    data[None] = row[width:]
+                yield data
 
 
 class JSONSource(DataSource):
-    def __init__(self, name: str, json_str: str):
+    """
+    Reads profiles from a JSON file holding either an array of objects or a
+    single object. Files up to ``stream_threshold`` bytes are parsed in one
+    go with orjson (falling back to json for NaN/Infinity literals); larger
+    arrays are streamed incrementally with ijson, which rejects those literals.
+    """
+    # orjson parses about 3x faster than ijson but needs the whole document in memory
+    stream_threshold = 16 << 20
+
+    def __init__(self, name: str, path: str):
         super().__init__(name)
-        self.json_str = json_str
+        self.path = path
+        self._schema: Optional[Tuple[Hashable, List[str]]] = None
 
-    def infer_schema(self):
-        data = json.loads(self.json_str)
-        if not data:
-            return []
+    def _open(self):
+        return open(self.path, "rb", buffering=READ_BUFFER_SIZE)
+
+    def cache_key(self):
+        return (self.path, os.stat(self.path).st_mtime_ns)
+
+    @staticmethod
+    def _is_array(f) -> bool:
+        while True:
+            c = f.read(1)
+            if not c.isspace():
+                f.seek(0)
+                return c == b"["
+
+    def _streamed(self, f) -> bool:
+        return os.fstat(f.fileno()).st_size > self.stream_threshold and self._is_array(f)
+
+    def _iter_objects(self):
+        with self._open() as f:
+            if self._streamed(f):
+                yield from ijson.items(f, "item", use_float=True)
+                return
+            data = _load_json_file(f.read())
         if isinstance(data, list):
-            return list({k for obj in data for k in obj.keys()})
-        return list(data.keys())
+            yield from data
+        elif data:
+            yield data
+
+    def infer_schema(self):
+        # Walk the token stream for object keys only: no values are built.
+        # Memoized until the file changes.
+        key = self.cache_key()
+        if self._schema is None or self._schema[0] != key:
+            with self._open() as f:
+                if self._streamed(f):
+                    fields = dict.fromkeys(
+                        value for path, event, value in ijson.parse(f)
+                        if event == "map_key" and path == "item"
+                    )
+                else:
+                    data = _load_json_file(f.read())
+                    objs = data if isinstance(data, list) else [data]
+                    fields = dict.fromkeys(k for obj in objs if isinstance(obj, dict) for k in obj)
+            self._schema = (key, list(fields))
+        return self._schema[1]
 
     def get_profiles(self):
-        data = json.loads(self.json_str)
-        if isinstance(data, list):
-            return [Profile(obj) for obj in data]
-        return [Profile(data)]
+        for obj in self._iter_objects():
+            yield Profile(obj)
 
-def recursive_match(base: Profile, sources: List[DataSource], llm: LLMClient, threshold=0.5) -> List[Dict[str, Any]]:
-    schema_agent = SchemaDetectorAgent(llm)
-    matcher = ProfileMatchingAgent(llm)
-    results = []
+    def iter_profiles_normalized(self, mapping, fields):
+        normalize = _make_normalizer(mapping, fields)
+        for obj in self._iter_objects():
+            yield obj, normalize(obj)
 
-    for src in sources:
-        base_fields = list(base.data.keys())
-        target_fields = schema_agent.detect(src)
-        mapping = schema_agent.align(base_fields, target_fields)
-        # print(mapping)
-
-        for p in src.get_profiles():
-            normalized = {}
-            for k, v in p.data.items():
-                base_field = mapping.get(k)
-                if base_field:
-                    normalized[base_field] = v.strip() if isinstance(v, str) else v
-                    print(normalized)
-
-            candidate = Profile(normalized)
-            res = matcher.compare(base, candidate)
-            score = res.get("score", 0)
-            print(f"📦 Source: {src.name}")
-            # print(f"   Raw profile: {p.data}")
-            # print(f"   Field mapping: {mapping}")
-            # print(f"   Normalized: {normalized}")
-            if score >= threshold:
-                print(f"\n✅ MATCH FOUND from {src.name} with score {score:.2f}")
-                for k, v in normalized.items():
-                    if k not in base.data or base.data[k] in (None, "", []):
-                        print(f"🔧 Enriching '{k}' → '{v}'")
-                        base.data[k] = v
-                res.update({"source": src.name, "candidate": normalized})
-                results.append(res)
-    return sorted(results, key=lambda x: x["score"], reverse=True)
+# Sized to the provider's concurrent-connection ceiling; more threads would
+# only queue on LLMClient's request slots
+MAX_WORKERS = 8
+_PREFILTERED = {"score": 0.0, "reason": "Filtered out before scoring: too little in common with the base profile"}
 
 
-def recursive_match_with_full_profiles(base: Profile, sources: List[DataSource], llm: LLMClient, threshold=0.5) -> List[Dict[str, Any]]:
+def _make_normalizer(mapping: Dict[str, str], target_fields: List[str]) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
     """
-    Enhanced version of recursive_match that includes full profile data in results.
-    This function calls the original recursive_match and then enhances results with complete profile information.
+    Builds a function turning a source row into a base-schema dict with
+    stripped string values. The (source field, base field) pairs are resolved
+    once per source, so each row only visits its mapped fields.
     """
-    schema_agent = SchemaDetectorAgent(llm)
-    matcher = ProfileMatchingAgent(llm)
+    position = {f: i for i, f in enumerate(target_fields)}
+    pairs = tuple(sorted(
+        ((k, v) for k, v in mapping.items() if v),
+        key=lambda kv: position.get(kv[0], len(position)),
+    ))
+
+    def normalize(data: Dict[str, Any]) -> Dict[str, Any]:
+        normalized = {}
+        for field, base_field in pairs:
+            if field in data:
+                v = data[field]
+                normalized[base_field] = v.strip() if isinstance(v, str) else v
+        return normalized
+
+    return normalize
+
+
+def _score_sources(base: Profile, sources: List[DataSource], schema_agent: SchemaDetectorAgent,
+                   matcher: ProfileMatchingAgent):
+    """
+    Aligns and scores all sources concurrently; the LLM calls are network-bound
+    so a thread pool overlaps them. Yields (src, mapping, row, normalized, result)
+    in source/row order. Candidates are scored against a snapshot of ``base`` so the
+    caller can enrich ``base.data`` while consuming the results.
+    """
+    snapshot = Profile(dict(base.data))
+    base_fields = list(snapshot.data.keys())
+
+    def align(src: DataSource) -> Tuple[List[str], Dict[str, str]]:
+        fields = schema_agent.detect(src)
+        return fields, schema_agent.align(base_fields, fields)
+
+    def score(chunk: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return matcher.compare_batch(snapshot, chunk)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        aligned = list(executor.map(align, sources))
+
+        # Rows that normalize to the same candidate are scored once and the
+        # result is fanned back out to each of them. Candidates with almost no
+        # characters in common with the base are dropped, and large sources are
+        # cut down to the candidates nearest the base, before any LLM call.
+        plans = []
+        tasks: List[List[Dict[str, Any]]] = []
+        for src, (fields, mapping) in zip(sources, aligned):
+            seen: Dict[bytes, int] = {}
+            unique: List[Dict[str, Any]] = []
+            rows = []
+            for row, normalized in src.iter_profiles_normalized(mapping, fields):
+                key = orjson.dumps(normalized, option=_DUMPS_OPTIONS)
+                idx = seen.setdefault(key, len(unique))
+                if idx == len(unique):
+                    unique.append(normalized)
+                rows.append((row, normalized, idx))
+            slot, version = (src.name, _dumps(mapping)), src.cache_key()
+            keep = matcher.overlapping(snapshot, unique, slot=slot, version=version)
+            if len(keep) > matcher.prefilter_k:
+                keep = matcher.nearest(snapshot, unique, slot=slot, version=version, among=keep)
+            chunks = list(chunked([unique[i] for i in keep], matcher.batch_size))
+            plans.append((src, mapping, rows, keep, len(chunks)))
+            tasks.extend(chunks)
+
+        scored = executor.map(score, tasks)
+        for src, mapping, rows, keep, n_chunks in plans:
+            results = dict(zip(keep, (res for _ in range(n_chunks) for res in next(scored))))
+            for row, normalized, idx in rows:
+                yield src, mapping, row, normalized, dict(results.get(idx, _PREFILTERED))
+
+
+def recursive_match(base: Profile, sources: List[DataSource], llm: LLMClient, threshold=0.5,
+                    schema_agent: Optional[SchemaDetectorAgent] = None,
+                    matcher: Optional[ProfileMatchingAgent] = None,
+                    include_full: bool = False) -> List[Dict[str, Any]]:
+    """
+    Scores every profile in ``sources`` against ``base``, enriching ``base``
+    with fields from matches at or above ``threshold``. With ``include_full``
+    each result also carries the complete original row and the field mapping
+    used, for display.
+    """
+    # Pass long-lived agents to reuse their caches across calls
+    schema_agent = schema_agent or SchemaDetectorAgent(llm)
+    matcher = matcher or ProfileMatchingAgent(llm)
     results = []
 
-    for src in sources:
-        base_fields = list(base.data.keys())
-        target_fields = schema_agent.detect(src)
-        mapping = schema_agent.align(base_fields, target_fields)
-
-        for p in src.get_profiles():
-            normalized = {}
-            for k, v in p.data.items():
-                base_field = mapping.get(k)
-                if base_field:
-                    normalized[base_field] = v.strip() if isinstance(v, str) else v
-
-            candidate = Profile(normalized)
-            res = matcher.compare(base, candidate)
-            score = res.get("score", 0)
-            print(f"📦 Source: {src.name}")
-            
-            if score >= threshold:
-                print(f"\n✅ MATCH FOUND from {src.name} with score {score:.2f}")
-                for k, v in normalized.items():
-                    if k not in base.data or base.data[k] in (None, "", []):
-                        print(f"🔧 Enriching '{k}' → '{v}'")
-                        base.data[k] = v
-                
-                # Include both normalized data (for enrichment) and full original profile data (for display)
-                res.update({
-                    "source": src.name, 
-                    "candidate": normalized,  # Normalized/mapped fields for enrichment
-                    "full_profile": p.data,   # Complete original profile data for display
-                    "field_mapping": mapping  # Field mapping for reference
-                })
-                results.append(res)
-    
+    for src, mapping, row, normalized, res in _score_sources(base, sources, schema_agent, matcher):
+        score = res.get("score", 0)
+        logger.debug("📦 Source: %s | normalized: %s", src.name, normalized)
+        if score >= threshold:
+            logger.debug("✅ Match found from %s with score %.2f", src.name, score)
+            # Fields the base lacks or holds empty (a missing key reads as None)
+            fill = {k: v for k, v in normalized.items() if base.data.get(k) in (None, "", [])}
+            if fill:
+                logger.debug("🔧 Enriching %s", fill)
+                base.update(fill)
+            res.update({"source": src.name, "candidate": normalized})
+            if include_full:
+                res["full_profile"] = row       # Complete original profile data for display
+                res["field_mapping"] = mapping  # Field mapping for reference
+            results.append(res)
     return sorted(results, key=lambda x: x["score"], reverse=True)
-
@@ -0,0 +1,32 @@
+import unittest
+
+from main import NLPreprocessorAgent
+
+extract = NLPreprocessorAgent._extract_deterministic
+
+
+class PassportPatternTest(unittest.TestCase):
+    def test_label_words_are_not_taken_as_the_number(self):
+        for text in (
+            "Search by passport number",
+            "his passport expired last year",
+            "whose passport is missing",
+            "find the person with passport details",
+        ):
+            with self.subTest(text=text):
+                self.assertNotIn("passport", extract(text)[0])
+
+    def test_labelled_numbers(self):
+        cases = {
+            "Passport A1234567": "A1234567",
+            "passport number: X1234567": "X1234567",
+            "PASSPORT NO. 987654321": "987654321",
+            "her passport is K12345678": "K12345678",
+        }
+        for text, number in cases.items():
+            with self.subTest(text=text):
+                self.assertEqual(extract(text)[0].get("passport"), number)
+
+
+if __name__ == "__main__":
+    unittest.main()